@@ -1397,7 +1397,10 @@ class QuestionBot(PayBot):
         self.pending_answers: dict[tuple[str, str], asyncio.Future[Message]] = {}
         self.requires_first_device: dict[str, bool] = {}
         self.failed_user_challenges: dict[str, int] = {}
-        self.TERMINAL_ANSWERS = "0 no none stop quit exit break cancel abort".split()
+        # only ever used for membership tests
+        self.TERMINAL_ANSWERS = frozenset(
+            "0 no none stop quit exit break cancel abort".split()
+        )
         self.AFFIRMATIVE_ANSWERS = (
             "yes yeah y yup affirmative ye sure yeh please".split()
         )
@@ -1896,7 +1899,16 @@ app.add_routes(
 # 3. download
 # 4. start process
 
+
+async def close_pdictng(_app: web.Application) -> None:
+    """Drains and closes pdictng's shared session, if any bot uses pdictng.
+    pdictng isn't imported here because it requires PAUTH."""
+    if pdictng := sys.modules.get("forest.pdictng"):
+        await pdictng.close_session()
+
+
 app.on_startup.append(add_tiprat)
+app.on_cleanup.append(close_pdictng)
 if utils.MEMFS:
     app.on_startup.append(autosave.start_memfs)
     app.on_startup.append(autosave.start_memfs_monitor)
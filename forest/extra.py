@@ -1,5 +1,6 @@
 # the alternative strategy is like, invent an intermediate representation and notation (and visual frontend), or parse Python and hope folks don't use layers of abstraction that one needs runtime introspection to destructure
 import ast
+import asyncio
 import sys
 import json
 import string
@@ -14,7 +15,7 @@ from forest.core import (
     requires_admin,
     get_uid,
 )
-from forest.pdictng import aPersistDict
+from forest.pdictng import aPersistDict, batch_set
 
 
 class GetStr(ast.NodeTransformer):
@@ -75,6 +76,8 @@ class TalkBack(QuestionBot):
         self.displayname_lookup_cache: aPersistDict[str] = aPersistDict(
             "displayname_lookup_cache"
         )
+        # lookups in progress, so concurrent calls for the same user share one
+        self._displayname_lookups: dict[str, asyncio.Task[str]] = {}
         super().__init__()
 
     async def handle_message(self, message: Message) -> Response:
@@ -86,6 +89,15 @@ class TalkBack(QuestionBot):
                 return f"Sent reply to {maybe_displayname}!"
         return await super().handle_message(message)
 
+    def persist_dicts(self) -> dict[str, aPersistDict]:
+        """Maps the tag (restore key) of each aPersistDict attribute set so far to the dict.
+        Only instance attributes can hold them, so there's no need to walk dir(self)."""
+        return {
+            value.tag: value
+            for value in vars(self).values()
+            if isinstance(value, aPersistDict)
+        }
+
     @requires_admin
     async def do_send(self, msg: Message) -> Response:
         """Send <recipient> <message>
@@ -97,8 +109,8 @@ class TalkBack(QuestionBot):
                 utils.get_secret("ADMIN"), f"Someone just used send:\n {msg}"
             )
         if obj and param:
-            if obj in await self.displayname_lookup_cache.keys():
-                obj = await self.displayname_lookup_cache.get(obj)
+            # resolve a displayname to a uuid, if it is one
+            obj = await self.displayname_lookup_cache.get(obj, obj)
             try:
                 result = await self.send_message(obj, param)
                 return result
@@ -122,7 +134,8 @@ class TalkBack(QuestionBot):
         return await self.do_send(msg)
 
     async def get_displayname(self, uuid: str) -> str:
-        """Retrieves a display name from a UUID, stores in the cache, handles error conditions."""
+        """Retrieves a display name from a UUID, stores in the cache, handles error conditions.
+        Concurrent cache misses for the same UUID wait on the same lookup."""
         uuid = uuid.strip("\u2068\u2069")
         # displayname provided, not uuid or phone
         if uuid.count("-") != 4 and not uuid.startswith("+"):
@@ -137,7 +150,21 @@ class TalkBack(QuestionBot):
             and " " not in maybe_displayname
         ):
             return maybe_displayname
+        lookup = self._displayname_lookups.get(uuid)
+        if not lookup:
+            lookup = asyncio.create_task(self._lookup_displayname(uuid))
+            self._displayname_lookups[uuid] = lookup
+            lookup.add_done_callback(
+                lambda _: self._displayname_lookups.pop(uuid, None)
+            )
+        # one caller being cancelled shouldn't cancel the lookup for the others
+        return await asyncio.shield(lookup)
+
+    async def _lookup_displayname(self, uuid: str) -> str:
+        """Builds a display name from the profile, fetching that if needed, and caches it."""
         maybe_user_profile = await self.profile_cache.get(uuid)
+        # cache writes, made together at the end
+        cache_writes: list[tuple[aPersistDict, str, Any]] = []
         # if no luck, but we have a valid uuid
         user_given = ""
         if (
@@ -148,7 +175,7 @@ class TalkBack(QuestionBot):
                     await self.signal_rpc_request("getprofile", peer_name=uuid)
                 ).blob or {}
                 user_given = maybe_user_profile.get("givenName", "")
-                await self.profile_cache.set(uuid, maybe_user_profile)
+                cache_writes.append((self.profile_cache, uuid, maybe_user_profile))
             except AttributeError:
                 # this returns a Dict containing an error key
                 user_given = "[error]"
@@ -161,8 +188,10 @@ class TalkBack(QuestionBot):
             user_short = f"{user_given}_{uuid.split('-')[1]}"
         else:
             user_short = user_given + uuid
-        await self.displayname_cache.set(uuid, user_short)
-        await self.displayname_lookup_cache.set(user_short, uuid)
+        cache_writes.append((self.displayname_cache, uuid, user_short))
+        cache_writes.append((self.displayname_lookup_cache, user_short, uuid))
+        # the caches are already updated in memory, so don't make the caller wait for the backend
+        await batch_set(cache_writes, wait=False)
         return user_short
 
     async def talkback(self, msg: Message) -> Response:
@@ -3,27 +3,161 @@
 # MIT LICENSE
 import asyncio
 import json
+import logging
 import os
 import time
-from typing import Any, Generic, Optional, TypeVar, overload
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import lru_cache
+from typing import Any, Generic, Optional, TypeVar, Union, overload
 import aiohttp
 from forest.cryptography import get_ciphertext_value, get_cleartext_value, hash_salt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
 NAMESPACE = os.getenv("FLY_APP_NAME") or open("/etc/hostname").read().strip()
 pAUTH = os.getenv("PAUTH", "")
 pURL = os.getenv("PURL", "https://gusc1-charming-parrot-31440.upstash.io")
+# connection pool sizing for the shared session
+POOL_SIZE = int(os.getenv("PDICT_POOL_SIZE", "100"))
+POOL_SIZE_PER_HOST = int(os.getenv("PDICT_POOL_SIZE_PER_HOST", "20"))
+TIMEOUT = float(os.getenv("PDICT_TIMEOUT", "30"))
+# seconds to wait for more writes to the same dict before sending them together
+WRITE_DELAY = float(os.getenv("PDICT_WRITE_DELAY", "0.01"))
+# seconds to wait before resending keys from a failed write, doubling up to MAX_RETRY_DELAY
+RETRY_DELAY = float(os.getenv("PDICT_RETRY_DELAY", "1"))
+MAX_RETRY_DELAY = 60.0
 
 if not pAUTH:
     raise ValueError("Need to set PAUTH envvar for persistence")
 
 
+def _dumps(obj: Any) -> str:
+    """JSON-encodes with orjson if it's installed, else with json"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj)
+
+
+def _loads(data: Union[str, bytes]) -> Any:
+    """JSON-decodes with orjson if it's installed, else with json.
+    json also reads the NaN and Infinity it writes, which orjson can't."""
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+# one connection pool per process, shared by every client, so keep-alive works across dicts
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    """Lazily creates the shared ClientSession. Must be called within a running loop."""
+    global _SESSION  # pylint: disable=global-statement
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=POOL_SIZE,
+                limit_per_host=POOL_SIZE_PER_HOST,
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
+            ),
+            timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+            json_serialize=_dumps,
+        )
+    return _SESSION
+
+
+# every write not yet sent to the backend, across all dicts
+_WRITES: set[asyncio.Task] = set()
+# set by close_session, so failed writes aren't retried on a session about to close
+_CLOSING = False
+
+
+async def close_session(_: Any = None) -> None:
+    """Waits for outstanding writes, then closes the shared ClientSession.
+    Can be used as an aiohttp on_cleanup hook."""
+    global _CLOSING  # pylint: disable=global-statement
+    _CLOSING = True
+    try:
+        # writes made while waiting add to _WRITES, so wait until it stays empty
+        while _WRITES:
+            await asyncio.gather(*_WRITES, return_exceptions=True)
+        if _SESSION and not _SESSION.closed:
+            await _SESSION.close()
+    finally:
+        _CLOSING = False
+
+
+@lru_cache(maxsize=4096)
+def _salted(key: str) -> str:
+    """Memoized hash_salt. The same few keys are hashed on every request."""
+    return hash_salt(key)
+
+
+# gzip + AES + base58 of a whole dict can take a while, so big values are handled off the event loop
+_CRYPTO_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pdictng")
+_OFFLOAD_SIZE = 4096
+
+
+async def _encrypt(data: str) -> str:
+    if len(data) < _OFFLOAD_SIZE:
+        return get_ciphertext_value(data)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_CRYPTO_POOL, get_ciphertext_value, data)
+
+
+async def _decrypt(data: str) -> str:
+    if len(data) < _OFFLOAD_SIZE:
+        return get_cleartext_value(data)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_CRYPTO_POOL, get_cleartext_value, data)
+
+
+async def _upstash_result(resp: aiohttp.ClientResponse) -> Any:
+    """Returns the JSON body of an Upstash response.
+    Raises if the request, or any command in a pipeline, failed: aiohttp doesn't,
+    and writes have to raise for _flush_after to keep their keys dirty and retry them."""
+    body = await resp.json()
+    replies = body if isinstance(body, list) else [body]
+    errors = [r["error"] for r in replies if isinstance(r, dict) and "error" in r]
+    if not resp.ok or errors:
+        raise ValueError(f"Upstash request failed ({resp.status}): {errors or body}")
+    return body
+
+
 class persistentKVStoreClient:
+    # whether the backend can store and update the fields of a key one at a time
+    supports_fields = False
+
     async def post(self, key: str, data: str) -> str:
         raise NotImplementedError
 
     async def get(self, key: str) -> str:
         raise NotImplementedError
 
+    async def post_field(self, key: str, field: str, data: Optional[str]) -> str:
+        """Sets (or, if data is None, deletes) a single field of a key."""
+        raise TypeError(f"{type(self).__name__} does not support fields")
+
+    async def post_fields(self, key: str, fields: dict[str, Optional[str]]) -> str:
+        """Sets (or deletes, where data is None) several fields of a key."""
+        results = await asyncio.gather(
+            *(self.post_field(key, field, data) for field, data in fields.items())
+        )
+        return results[-1] if results else ""
+
+    async def get_fields(self, key: str) -> Optional[dict[str, str]]:
+        """Returns all fields of a key, or None if fields were never stored for it."""
+        # pylint: disable=unused-argument
+        return None
+
 
 class fasterpKVStoreClient(persistentKVStoreClient):
     """Strongly consistent, persistent storage.
@@ -32,6 +166,10 @@ class fasterpKVStoreClient(persistentKVStoreClient):
     Check out <https://github.com/mobilecoinofficial/forest/blob/main/pdictng_docs/upstash_pauth.png> for setup / pAUTH
     """
 
+    supports_fields = True
+    # salted field names are base58, so this can never collide with one
+    field_marker = "_"
+
     def __init__(
         self,
         base_url: str = pURL,
@@ -39,7 +177,6 @@ class fasterpKVStoreClient(persistentKVStoreClient):
         namespace: str = NAMESPACE,
     ):
         self.url = base_url
-        self.conn = aiohttp.ClientSession()
         self.auth = auth_str
         self.namespace = hash_salt(namespace)
         self.exists: dict[str, bool] = {}
@@ -48,28 +185,88 @@ class fasterpKVStoreClient(persistentKVStoreClient):
         }
 
     async def post(self, key: str, data: str) -> str:
-        key = hash_salt(f"{self.namespace}_{key}")
-        data = get_ciphertext_value(data)
+        key = _salted(f"{self.namespace}_{key}")
+        data = await _encrypt(data)
         # try to set
-        async with self.conn.post(
+        async with (await _get_session()).post(
             f"{self.url}/SET/{key}", headers=self.headers, data=data
         ) as resp:
-            return await resp.json()
+            return await _upstash_result(resp)
 
     async def get(self, key: str) -> str:
         """Get and return value of an object with the specified key and namespace"""
-        key = hash_salt(f"{self.namespace}_{key}")
-        async with self.conn.get(f"{self.url}/GET/{key}", headers=self.headers) as resp:
+        key = _salted(f"{self.namespace}_{key}")
+        async with (await _get_session()).get(
+            f"{self.url}/GET/{key}", headers=self.headers
+        ) as resp:
             res = await resp.json()
-            if "result" in res:
-                return get_cleartext_value(res["result"])
+            # a missing key is {"result": null}
+            if res.get("result") is not None:
+                return await _decrypt(res["result"])
 
         return ""
 
+    async def post_field(self, key: str, field: str, data: Optional[str]) -> str:
+        """Sets a field of a Redis hash with HSET, or removes it with HDEL if data is None.
+        Field names are salted, and the cleartext field name is stored encrypted with the value
+        so that get_fields can recover it. Every HSET also sets a marker field,
+        so a hash that had all its fields deleted can be told apart from one that never existed.
+        """
+        key = _salted(f"{self.namespace}_{key}_fields")
+        salted_field = _salted(field)
+        if data is None:
+            async with (await _get_session()).get(
+                f"{self.url}/HDEL/{key}/{salted_field}", headers=self.headers
+            ) as resp:
+                return await _upstash_result(resp)
+        data = await _encrypt(_dumps([field, data]))
+        async with (await _get_session()).post(
+            f"{self.url}/HSET/{key}/{self.field_marker}/1/{salted_field}",
+            headers=self.headers,
+            data=data,
+        ) as resp:
+            return await _upstash_result(resp)
+
+    async def post_fields(self, key: str, fields: dict[str, Optional[str]]) -> str:
+        """Like post_field, but for several fields in one request.
+        Sends at most one HSET and one HDEL through Upstash's /pipeline endpoint."""
+        key = _salted(f"{self.namespace}_{key}_fields")
+        hset = ["HSET", key, self.field_marker, "1"]
+        hdel = ["HDEL", key]
+        for field, data in fields.items():
+            if data is None:
+                hdel.append(_salted(field))
+            else:
+                hset += [_salted(field), await _encrypt(_dumps([field, data]))]
+        commands = [cmd for cmd in (hset, hdel) if len(cmd) > 2]
+        if not commands:
+            return ""
+        async with (await _get_session()).post(
+            f"{self.url}/pipeline", headers=self.headers, json=commands
+        ) as resp:
+            return await _upstash_result(resp)
+
+    async def get_fields(self, key: str) -> Optional[dict[str, str]]:
+        """Get all the fields of a hash stored with post_field with HGETALL."""
+        key = _salted(f"{self.namespace}_{key}_fields")
+        async with (await _get_session()).get(
+            f"{self.url}/HGETALL/{key}", headers=self.headers
+        ) as resp:
+            # don't mistake a failed read for a missing hash, or init would migrate stale data
+            body = await _upstash_result(resp)
+        if not isinstance(body.get("result"), list):
+            raise ValueError(f"HGETALL failed for {key}: {body}")
+        res = body["result"]
+        flat = dict(zip(res[::2], res[1::2]))
+        if self.field_marker not in flat:
+            return None
+        flat.pop(self.field_marker)
+        return dict([_loads(await _decrypt(value)) for value in flat.values()])
+
 
 class fastpKVStoreClient(persistentKVStoreClient):
     """Strongly consistent, persistent storage.
-    Stores a sneak table mapping keys to their existence to update faster.
+    Writes are single-request upserts on key_.
     On top of Postgresql and Postgrest.
     Schema:
                                          Table "public.keyvalue"
@@ -96,84 +293,56 @@ class fastpKVStoreClient(persistentKVStoreClient):
         namespace: str = NAMESPACE,
     ):
         self.url = base_url
-        self.conn = aiohttp.ClientSession()
         self.auth = auth_str
         self.namespace = hash_salt(namespace)
-        self.exists: dict[str, bool] = {}
         self.headers = {
             "Content-Type": "application/json",
             "apikey": f"{self.auth}",
             "Authorization": f"Bearer {self.auth}",
-            "Prefer": "return=representation",
+            # insert, or update the row if key_ already exists
+            "Prefer": "resolution=merge-duplicates,return=representation",
+        }
+        self._upsert_url = f"{self.url}?on_conflict=key_"
+        # the namespace never changes, so only the (base58) key is appended per request
+        self._select_url = (
+            f"{self.url}?select=value&namespace=eq.{self.namespace}&key_=eq."
+        )
+        self._get_headers = {
+            "Accept": "application/octet-stream",
+            "apikey": f"{self.auth}",
+            "Authorization": f"Bearer {self.auth}",
         }
 
     async def post(self, key: str, data: str) -> str:
-        key = hash_salt(key)
-        data = get_ciphertext_value(data)
-        # try to set
-        if self.exists.get(key):
-            async with self.conn.patch(
-                f"{self.url}?key_=eq.{key}&namespace=eq.{self.namespace}",
-                headers=self.headers,
-                data=json.dumps(
-                    dict(
-                        value=data,
-                        updated_at=time.time(),
-                        namespace=self.namespace,
-                    )
-                ),
-            ) as resp:
-                return await resp.json()
-        async with self.conn.post(
-            f"{self.url}",
+        key = _salted(key)
+        data = await _encrypt(data)
+        async with (await _get_session()).post(
+            self._upsert_url,
             headers=self.headers,
-            data=json.dumps(
-                dict(
-                    key_=key,
-                    value=data,
-                    created_at=time.time(),
-                    namespace=self.namespace,
-                )
+            json=dict(
+                key_=key,
+                value=data,
+                updated_at=time.time(),
+                namespace=self.namespace,
             ),
         ) as resp:
-            resp_text = await resp.text()
-            # if set fails
-            if "duplicate key value violates unique constraint" in resp_text:
-                self.exists[key] = True
-                # do update (patch not post)
-                async with self.conn.patch(
-                    f"{self.url}?key_=eq.{key}&namespace=eq.{self.namespace}",
-                    headers=self.headers,
-                    data=json.dumps(
-                        dict(
-                            value=data,
-                            updated_at=time.time(),
-                            namespace=self.namespace,
-                        )
-                    ),
-                ) as resp:
-                    return await resp.json()
-            return json.loads(resp_text)
+            return await resp.json()
 
     async def get(self, key: str) -> str:
         """Get and return value of an object with the specified key and namespace"""
-        key = hash_salt(key)
-        async with self.conn.get(
-            f"{self.url}?select=value&key_=eq.{key}&namespace=eq.{self.namespace}",
-            headers={
-                "Accept": "application/octet-stream",
-                "apikey": f"{self.auth}",
-                "Authorization": f"Bearer {self.auth}",
-            },
+        key = _salted(key)
+        async with (await _get_session()).get(
+            self._select_url + key, headers=self._get_headers
         ) as resp:
             maybe_res = await resp.text()
             if maybe_res:
-                self.exists[key] = True
-                return get_cleartext_value(maybe_res)
+                return await _decrypt(maybe_res)
             return ""
 
 
 V = TypeVar("V")
+# lets get() tell a missing key apart from a falsy value
+_MISSING: Any = object()
 # V = TypeVar("V", str, int, list, dict[str, str])
 # that would be nice but causes an error with aPersistDictOfLists
 # Value of type variable "V" of "aPersistDict" cannot be "list"
@@ -205,6 +374,8 @@ class aPersistDict(Generic[V]):
             self.tag = args[0]
         if "tag" in kwargs:
             self.tag = kwargs.pop("tag")
+        # the backend key everything is stored under, fixed for the life of the dict
+        self.client_key = f"Persist_{self.tag}_{NAMESPACE}"
         self.dict_: dict[str, Any] = {}
         self.client: persistentKVStoreClient = (
             fastpKVStoreClient() if "supabase" in pURL else fasterpKVStoreClient()
@@ -212,7 +383,20 @@ class aPersistDict(Generic[V]):
         self.rwlock = asyncio.Lock()
         self.loop = asyncio.get_event_loop()
         self.init_task = asyncio.create_task(self.finish_init(**kwargs))
-        self.write_task: Optional[asyncio.Task] = None
+        # d[key] = value is queued here, and applied in order by a single writer
+        self._write_q: asyncio.Queue[tuple[str, Optional[V]]] = asyncio.Queue()
+        self._writer = asyncio.create_task(self._writer_loop())
+        # keys changed in memory but not yet sent, and the task that will send them
+        self._dirty: set[str] = set()
+        self._pending_write: Optional[asyncio.Task[str]] = None
+        # the keys a flush is sending right now, and that flush
+        self._sending: set[str] = set()
+        self._sending_write: Optional[asyncio.Task] = None
+        # a flush resending keys after a failure, which sleeps through a backoff first
+        self._retry: Optional[asyncio.Task[str]] = None
+        self._flush_lock = asyncio.Lock()
+        # failed flushes in a row, for backing off retries
+        self._failures = 0
 
     def __repr__(self) -> str:
         return f"a{self.dict_}"
@@ -221,22 +405,51 @@ class aPersistDict(Generic[V]):
         return f"a{self.dict_}"
 
     async def __getitem__(self, key: str) -> V:
-        if value := await self.get(key):
-            return value
-        raise KeyError(key)
+        value = await self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
 
     def __setitem__(self, key: str, value: V) -> None:
-        if self.write_task and not self.write_task.done():
-            raise ValueError("Can't set value. write_task incomplete.")
-        self.write_task = asyncio.create_task(self.set(key, value))
+        self._write_q.put_nowait((key, value))
+
+    async def _writer_loop(self) -> None:
+        """Applies the writes queued by __setitem__, in order."""
+        # like _loaded, a failed init shouldn't stop the queue from draining
+        with suppress(Exception):
+            await self.init_task
+        while True:
+            key, value = await self._write_q.get()
+            try:
+                async with self.rwlock:
+                    # get() waits for the write task itself
+                    self._set(key, value)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("failed to set %s in %s", key, self.tag)
+            finally:
+                self._write_q.task_done()
 
     async def finish_init(self, **kwargs: Any) -> None:
         """Does the asynchrnous part of the initialisation process."""
         async with self.rwlock:
-            key = f"Persist_{self.tag}_{NAMESPACE}"
-            result = await self.client.get(key)
-            if result:
-                self.dict_ = json.loads(result)
+            key = self.client_key
+            fields = None
+            if self.client.supports_fields:
+                fields = await self.client.get_fields(key)
+            if fields is not None:
+                self.dict_ = {k: _loads(v) for k, v in fields.items()}
+            else:
+                # no fields yet, load the whole-dict value written by older versions
+                result = await self.client.get(key)
+                if result:
+                    self.dict_ = _loads(result)
+                if self.client.supports_fields and self.dict_:
+                    # migrate, leaving the old value in place so older versions can still read it.
+                    # post_fields raises if this fails, and once it works the marker field
+                    # means get_fields finds the hash, so it isn't migrated again
+                    await self.client.post_fields(
+                        key, {k: _dumps(v) for k, v in self.dict_.items()}
+                    )
             self.dict_.update(**kwargs)
 
     @overload
@@ -248,26 +461,46 @@ class aPersistDict(Generic[V]):
         ...
 
     async def get(self, key: str, default: Optional[V] = None) -> Optional[V]:
-        """Analogous to dict().get() - but async. Waits until writes have completed on the backend before returning results."""
-        # always wait for pending writes - where a task has been created but lock not held
-        if self.write_task:
-            await self.write_task
-            self.write_task = None
-        # then grab the lock
-        async with self.rwlock:
-            return self.dict_.get(key) or default
+        """Analogous to dict().get() - but async. Waits until writes of this key have completed on the backend before returning results."""
+        # writes queued by __setitem__ are applied in memory first
+        await self._write_q.join()
+        await self._loaded()
+        write = self._write_of(key)
+        # wait() doesn't raise, so a failed write (logged and retried by _flush_done)
+        # isn't reported to readers, and doesn't cancel the write if this get is cancelled
+        if write and not write.done():
+            await asyncio.wait([write])
+        value = self.dict_.get(key, _MISSING)
+        return default if value is _MISSING else value
+
+    def _write_of(self, key: str) -> Optional[asyncio.Task]:
+        """Returns the flush that will send key, if there is one worth waiting for.
+        A retry sleeping through its backoff isn't: readers get the value in memory instead."""
+        if key in self._dirty and self._pending_write is not self._retry:
+            return self._pending_write
+        if key in self._sending:
+            return self._sending_write
+        return None
+
+    async def _loaded(self) -> None:
+        """Waits for finish_init.
+        Reads don't take rwlock: writers only hold it while mutating dict_ in memory,
+        never across an await, except during init.
+        Writers wait too, so init can't load over (or migrate) values set before it ran."""
+        if not self.init_task.done():
+            await self.init_task
 
     async def keys(self) -> list[str]:
-        async with self.rwlock:
-            return list(self.dict_.keys())
+        await self._loaded()
+        return list(self.dict_.keys())
 
     async def values(self) -> list[V]:
-        async with self.rwlock:
-            return list(self.dict_.values())
+        await self._loaded()
+        return list(self.dict_.values())
 
     async def items(self) -> list[tuple[str, V]]:
-        async with self.rwlock:
-            return list(self.dict_.items())
+        await self._loaded()
+        return list(self.dict_.items())
 
     async def remove(self, key: str) -> None:
         """Removes a value from the map, if it exists."""
@@ -288,21 +521,117 @@ class aPersistDict(Generic[V]):
         await self.set(key, None)
         return res
 
-    async def _set(self, key: str, value: Optional[V]) -> str:
-        """Sets a value at a given key, returns metadata.
-        This function exists so *OTHER FUNCTIONS* holding the lock can set values."""
+    def _set(self, key: str, value: Optional[V]) -> "asyncio.Task[str]":
+        """Sets a value at a given key and schedules the write to the backend.
+        This function exists so *OTHER FUNCTIONS* holding the lock can set values.
+        Returns the write task, which resolves to metadata. Await it after releasing the lock,
+        so that writes made in the meantime can be sent with it."""
         if key is not None and value is not None:
             self.dict_.update({key: value})
         elif key and value is None and key in self.dict_:
             self.dict_.pop(key)
-        client_key = f"Persist_{self.tag}_{NAMESPACE}"
-        client_value = json.dumps(self.dict_)
-        return await self.client.post(client_key, client_value)
+        self._dirty.add(key)
+        return self._pending_write or self._schedule_flush(WRITE_DELAY)
+
+    def _schedule_flush(self, delay: float) -> "asyncio.Task[str]":
+        """Starts the task that will send the dirty keys after delay seconds."""
+        self._pending_write = asyncio.create_task(self._flush_after(delay))
+        _WRITES.add(self._pending_write)
+        self._pending_write.add_done_callback(_WRITES.discard)
+        self._pending_write.add_done_callback(self._flush_done)
+        return self._pending_write
+
+    def _flush_done(self, write: "asyncio.Task[str]") -> None:
+        """Lets the next write start a new flush, even if this one was cancelled during its sleep.
+        If the flush failed, logs the error and retries its keys, since background writes
+        (batch_set with wait=False) have nobody else to report to."""
+        if self._pending_write is write:
+            self._pending_write = None
+        if self._retry is write:
+            self._retry = None
+        if write.cancelled():
+            return
+        error = write.exception()
+        if not error:
+            self._failures = 0
+            return
+        if _CLOSING:
+            logging.error("failed to write %s while closing: %r", self.tag, error)
+            return
+        self._failures += 1
+        delay = min(RETRY_DELAY * 2 ** (self._failures - 1), MAX_RETRY_DELAY)
+        logging.error("failed to write %s, retrying in %ss: %r", self.tag, delay, error)
+        # a write made since will already send these keys
+        if self._dirty and not self._pending_write:
+            self._retry = self._schedule_flush(delay)
+
+    async def _flush_after(self, delay: float) -> str:
+        """Waits for more writes, then sends every dirty key to the backend at once."""
+        await asyncio.sleep(delay)
+        # flushes are sent one at a time so they can't land out of order
+        async with self._flush_lock:
+            # writes made from here on go in the next flush
+            self._pending_write = None
+            dirty, self._dirty = self._dirty, set()
+            self._sending, self._sending_write = dirty, asyncio.current_task()
+            client_key = self.client_key
+            try:
+                if self.client.supports_fields:
+                    # only send the fields that changed
+                    return await self.client.post_fields(
+                        client_key,
+                        {
+                            key: _dumps(self.dict_[key]) if key in self.dict_ else None
+                            for key in dirty
+                        },
+                    )
+                client_value = _dumps(self.dict_)
+                return await self.client.post(client_key, client_value)
+            except BaseException:
+                # keep the keys dirty so the next flush sends them
+                self._dirty |= dirty
+                raise
+            finally:
+                self._sending, self._sending_write = set(), None
 
     async def set(self, key: str, value: Optional[V]) -> str:
         """Sets a value at a given key, returns metadata."""
+        await self._loaded()
+        async with self.rwlock:
+            write = self._set(key, value)
+        # shielded so cancelling one writer doesn't cancel the flush shared with others
+        return await asyncio.shield(write)
+
+    async def set_many(self, items: dict[str, Optional[V]]) -> str:
+        """Sets several values under one lock, sent to the backend in one flush. Returns metadata."""
+        if not items:
+            return ""
+        return await asyncio.shield(await self._set_many(items))
+
+    async def _set_many(self, items: dict[str, Optional[V]]) -> "asyncio.Task[str]":
+        """Sets several values in memory, returning the write task without waiting for it."""
+        await self._loaded()
         async with self.rwlock:
-            return await self._set(key, value)
+            for key, value in items.items():
+                write = self._set(key, value)
+        return write
+
+
+async def batch_set(
+    ops: list[tuple[aPersistDict, str, Any]], wait: bool = True
+) -> list[str]:
+    """Sets (dict, key, value) triples across several dicts.
+    Each dict gets one flush, and the flushes happen concurrently.
+    With wait=False, returns as soon as the values are set in memory and leaves
+    the writes to finish in the background. get() of those keys and close_session() still wait for them.
+    """
+    grouped: dict[aPersistDict, dict[str, Any]] = {}
+    for pdict, key, value in ops:
+        grouped.setdefault(pdict, {})[key] = value
+    writes = [await pdict._set_many(items) for pdict, items in grouped.items()]
+    if not wait:
+        return []
+    return list(await asyncio.gather(*map(asyncio.shield, writes)))
 
 
 class aPersistDictOfInts(aPersistDict[int]):
@@ -310,21 +639,25 @@ class aPersistDictOfInts(aPersistDict[int]):
         """Since one cannot simply add to a coroutine, this function exists.
         If the key exists and the value is None, or an empty array, the provided value is added to a(the) list at that value."""
         value_to_extend: Any = 0
+        await self._loaded()
         async with self.rwlock:
             value_to_extend = self.dict_.get(key, 0)
-            if isinstance(value_to_extend, int):
-                return await self._set(key, value_to_extend + value)
-            raise TypeError(f"key {key} is not an int")
+            if not isinstance(value_to_extend, int):
+                raise TypeError(f"key {key} is not an int")
+            write = self._set(key, value_to_extend + value)
+        return await asyncio.shield(write)
 
     async def decrement(self, key: str, value: int) -> str:
         """Since one cannot simply add to a coroutine, this function exists.
         If the key exists and the value is None, or an empty array, the provided value is added to a(the) list at that value."""
         value_to_extend: Any = 0
+        await self._loaded()
         async with self.rwlock:
             value_to_extend = self.dict_.get(key, 0)
-            if isinstance(value_to_extend, int):
-                return await self._set(key, value_to_extend - value)
-            raise TypeError(f"key {key} is not an int")
+            if not isinstance(value_to_extend, int):
+                raise TypeError(f"key {key} is not an int")
+            write = self._set(key, value_to_extend - value)
+        return await asyncio.shield(write)
 
 
 I = TypeVar("I")  # inner value
@@ -337,21 +670,28 @@ class aPersistDictOfLists(aPersistDict[list[I]]):
         """Since one cannot simply add to a coroutine, this function exists.
         If the key exists and the value is None, or an empty array, the provided value is added to a(the) list at that value."""
         value_to_extend: Optional[list[I]] = []
+        await self._loaded()
         async with self.rwlock:
             value_to_extend = self.dict_.get(key, [])
-            if isinstance(value_to_extend, list):
-                value_to_extend.append(value)
-                return await self._set(key, value_to_extend)
-            raise TypeError(f"value {value_to_extend} for key {key} is not a list")
+            if not isinstance(value_to_extend, list):
+                raise TypeError(f"value {value_to_extend} for key {key} is not a list")
+            value_to_extend.append(value)
+            write = self._set(key, value_to_extend)
+        return await asyncio.shield(write)
 
     async def remove_from(self, key: str, not_value: I) -> str:
         """Removes a value specified from the list, if present.
         Returns metadata"""
+        await self._loaded()
         async with self.rwlock:
             values_to_filter = self.dict_.get(key, [])
-            if isinstance(values_to_filter, list):
-                values_without_specified = [
-                    el for el in values_to_filter if not_value != el
-                ]
-                return await self._set(key, values_without_specified)
-            raise TypeError(f"key {key} is not a list")
+            if not isinstance(values_to_filter, list):
+                raise TypeError(f"key {key} is not a list")
+            if not_value not in values_to_filter:
+                # nothing to remove, so nothing to write
+                return ""
+            values_without_specified = [
+                el for el in values_to_filter if not_value != el
+            ]
+            write = self._set(key, values_without_specified)
+        return await asyncio.shield(write)
@@ -34,11 +34,7 @@ class Charity(DialogBot):
         )
         self.charities_balance_mmob = aPersistDictOfInts("charities_balance_mmob")
         # okay, this now maps the tag (restore key) of each of the above to the instance of the PersistDict class
-        self.state = {
-            self.__getattribute__(attr).tag: self.__getattribute__(attr)
-            for attr in dir(self)
-            if isinstance(self.__getattribute__(attr), aPersistDict)
-        }
+        self.state = self.persist_dicts()
         super().__init__()
 
     @requires_admin
@@ -64,11 +64,7 @@ class Teddy(DialogBot):
             "followup_confirmed"
         )
         # okay, this now maps the tag (restore key) of each of the above to the instance of the PersistDict class
-        self.state = {
-            self.__getattribute__(attr).tag: self.__getattribute__(attr)
-            for attr in dir(self)
-            if isinstance(self.__getattribute__(attr), aPersistDict)
-        }
+        self.state = self.persist_dicts()
         super().__init__()
 
     @requires_admin
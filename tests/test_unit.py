@@ -1,15 +1,20 @@
 import asyncio
 import logging
+import math
 import os
 import pathlib
 from importlib import reload
+from typing import Any, Optional
 import pytest
 import pytest_asyncio
 
 # Prevent Utils from importing dev_secrets by default
 os.environ["ENV"] = "test"
+# pdictng refuses to import without it; tests swap in FakeKVStoreClient so it's never sent
+os.environ.setdefault("PAUTH", "test")
 
-from forest import utils, core
+from forest import utils, core, pdictng
+from forest.cryptography import get_cleartext_value
 from forest.core import Message, Response
 from tests.mockbot import MockBot
 
@@ -154,3 +159,327 @@ async def test_questions(bot) -> None:
     await asyncio.sleep(0)
     await bot.send_input("yes")
     assert await choice == "XXL"
+
+
+def test_pdict_json(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Tests that values written with or without orjson read back the same either way"""
+    orjson = pdictng.orjson
+    if not orjson:
+        pytest.skip("orjson isn't installed")
+    value = {1: ["a", 2.5, None, True], "b": {"c": []}}
+    written = []
+    for module in (orjson, None):
+        monkeypatch.setattr(pdictng, "orjson", module)
+        written.append((pdictng._dumps(value), pdictng._dumps(float("nan"))))
+    for module in (orjson, None):
+        monkeypatch.setattr(pdictng, "orjson", module)
+        for dumped, dumped_nan in written:
+            # non-str keys become strings, like json does
+            assert pdictng._loads(dumped) == {
+                "1": ["a", 2.5, None, True],
+                "b": {"c": []},
+            }
+            nan = pdictng._loads(dumped_nan)
+            # orjson writes NaN as null, json as NaN, which orjson reads through json
+            assert nan is None if dumped_nan == "null" else math.isnan(nan)
+
+
+class FakeKVStoreClient(pdictng.persistentKVStoreClient):
+    """Records the fields posted to it instead of sending them, and can be told to fail."""
+
+    supports_fields = True
+
+    def __init__(self) -> None:
+        self.posts: list[dict] = []
+        self.failures = 0
+
+    async def get(self, key: str) -> str:
+        return ""
+
+    async def post(self, key: str, data: str) -> str:
+        raise AssertionError("fields should be posted one by one")
+
+    async def get_fields(self, key: str) -> dict:
+        return {}
+
+    async def post_fields(self, key: str, fields: dict) -> str:
+        await asyncio.sleep(0)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("backend is down")
+        self.posts.append(fields)
+        return "OK"
+
+
+@pytest.fixture(name="client")
+def fake_client(monkeypatch: pytest.MonkeyPatch) -> FakeKVStoreClient:
+    """Makes new pdicts use one FakeKVStoreClient, and retry failed writes right away"""
+    client = FakeKVStoreClient()
+    monkeypatch.setattr(pdictng, "fasterpKVStoreClient", lambda: client)
+    monkeypatch.setattr(pdictng, "fastpKVStoreClient", lambda: client)
+    monkeypatch.setattr(pdictng, "RETRY_DELAY", 0.0)
+    return client
+
+
+@pytest.mark.asyncio
+async def test_pdict_falsy_values(client: FakeKVStoreClient) -> None:
+    """Tests that falsy values are returned instead of the default"""
+    pdict: pdictng.aPersistDict = pdictng.aPersistDict("falsy")
+    await pdict.set("zero", 0)
+    pdict["empty"] = ""
+    assert await pdict.get("zero", 1) == 0
+    assert await pdict.get("empty", "default") == ""
+    assert await pdict["zero"] == 0
+    with pytest.raises(KeyError):
+        await pdict["missing"]
+    assert client.posts == [{"zero": "0"}, {"empty": '""'}]
+
+
+@pytest.mark.asyncio
+async def test_pdict_remove_from_missing(client: FakeKVStoreClient) -> None:
+    """Tests that removing a value that isn't in the list doesn't write anything"""
+    pdict: pdictng.aPersistDictOfLists[int] = pdictng.aPersistDictOfLists("lists")
+    await pdict.extend("numbers", 1)
+    assert client.posts == [{"numbers": "[1]"}]
+    assert await pdict.remove_from("numbers", 2) == ""
+    assert await pdict.remove_from("nothing", 2) == ""
+    assert len(client.posts) == 1
+    await pdict.remove_from("numbers", 1)
+    assert client.posts[-1] == {"numbers": "[]"}
+
+
+@pytest.mark.asyncio
+async def test_pdict_coalesces_writes(client: FakeKVStoreClient) -> None:
+    """Tests that writes made close together are sent in one flush"""
+    pdict: pdictng.aPersistDictOfInts = pdictng.aPersistDictOfInts("coalesce")
+    pdict["a"] = 1
+    results = await asyncio.gather(
+        pdict.set("b", 2), pdict.increment("c", 3), pdict.set_many({"d": 4, "e": 5})
+    )
+    assert results == ["OK"] * 3
+    assert client.posts == [{"a": "1", "b": "2", "c": "3", "d": "4", "e": "5"}]
+
+
+@pytest.mark.asyncio
+async def test_pdict_cancelled_writes(client: FakeKVStoreClient) -> None:
+    """Tests that cancelling one writer, or a flush, doesn't lose or block other writes"""
+    pdict: pdictng.aPersistDict = pdictng.aPersistDict("cancel")
+    await pdict.init_task
+    first = asyncio.create_task(pdict.set("a", 1))
+    second = asyncio.create_task(pdict.set("b", 2))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == "OK"
+    assert client.posts == [{"a": "1", "b": "2"}]
+    # a flush cancelled while it waits for more writes leaves its keys for the next one
+    flush = pdict._set("c", 3)
+    flush.cancel()
+    await asyncio.wait([flush])
+    assert await asyncio.wait_for(pdict.set("d", 4), 1) == "OK"
+    assert client.posts[-1] == {"c": "3", "d": "4"}
+
+
+@pytest.mark.asyncio
+async def test_pdict_failed_writes(client: FakeKVStoreClient) -> None:
+    """Tests that a failed flush is reported to its writers, not readers, and retried"""
+    pdict: pdictng.aPersistDict = pdictng.aPersistDict("fail")
+    await pdict.init_task
+    client.failures = 1
+    with pytest.raises(ConnectionError):
+        await pdict.set("a", 1)
+    # the retry sends the keys the failed flush couldn't
+    assert pdict._retry
+    await pdict._retry
+    assert client.posts == [{"a": "1"}]
+    # background writes that fail are retried, and get() doesn't raise their errors
+    client.failures = 1
+    await pdictng.batch_set([(pdict, "c", 3)], wait=False)
+    assert await asyncio.wait_for(pdict.get("c"), 1) == 3
+    await pdict._retry
+    assert client.posts == [{"a": "1"}, {"c": "3"}]
+    assert not pdict._dirty
+
+
+@pytest.mark.asyncio
+async def test_pdict_reads_wait_for_own_key(
+    client: FakeKVStoreClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Tests that reads only wait for writes of their key, and never for a retry's backoff"""
+    monkeypatch.setattr(pdictng, "RETRY_DELAY", 60.0)
+    pdict: pdictng.aPersistDict = pdictng.aPersistDict("reads")
+    await pdict.set("a", 1)
+    await pdictng.batch_set([(pdict, "b", 2)], wait=False)
+    assert await pdict.get("a") == 1
+    assert client.posts == [{"a": "1"}]
+    assert await pdict.get("b") == 2
+    assert client.posts == [{"a": "1"}, {"b": "2"}]
+    # while a failed write sleeps before its retry, reads return the value in memory
+    client.failures = 1
+    await pdictng.batch_set([(pdict, "c", 3)], wait=False)
+    assert await asyncio.wait_for(pdict.get("c"), 1) == 3
+    assert pdict._retry
+    assert await asyncio.wait_for(pdict.get("c"), 0.5) == 3
+    assert await asyncio.wait_for(pdict.get("a"), 0.5) == 1
+    pdict._retry.cancel()
+
+
+@pytest.mark.asyncio
+async def test_pdict_close_session(client: FakeKVStoreClient) -> None:
+    """Tests that close_session waits for writes, and doesn't retry ones that fail"""
+    pdict: pdictng.aPersistDict = pdictng.aPersistDict("close")
+    await pdict.init_task
+    client.failures = 1
+    await pdictng.batch_set([(pdict, "a", 1)], wait=False)
+    await asyncio.wait_for(pdictng.close_session(), 1)
+    assert not pdictng._WRITES
+    assert pdict._retry is None
+    assert pdict._dirty == {"a"}
+    # the failed key stays dirty, so the next write sends it
+    await pdict.set("b", 2)
+    assert client.posts == [{"a": "1", "b": "2"}]
+
+
+class FakeUpstashResponse:
+    def __init__(self, status: int, body: Any) -> None:
+        self.status = status
+        self.ok = status < 400
+        self.body = body
+
+    async def json(self) -> Any:
+        return self.body
+
+    async def __aenter__(self) -> "FakeUpstashResponse":
+        return self
+
+    async def __aexit__(self, *_: Any) -> None:
+        pass
+
+
+class FakeUpstash:
+    """Stands in for pdictng's aiohttp session, answering Upstash REST requests from a dict.
+    Commands named in failing reply with an error, like Upstash does when over its limits."""
+
+    def __init__(self) -> None:
+        self.store: dict[str, Any] = {}
+        self.requests: list[tuple[str, Any]] = []
+        self.failing: set[str] = set()
+
+    def run(self, cmd: str, key: str, *args: str) -> dict:
+        if cmd in self.failing:
+            return {"error": "ERR max requests limit exceeded"}
+        if cmd == "SET":
+            self.store[key] = args[0]
+            return {"result": "OK"}
+        if cmd == "GET":
+            return {"result": self.store.get(key)}
+        if cmd == "HSET":
+            self.store.setdefault(key, {}).update(zip(args[::2], args[1::2]))
+            return {"result": len(args) // 2}
+        if cmd == "HDEL":
+            fields = self.store.get(key, {})
+            return {"result": len([fields.pop(arg) for arg in args if arg in fields])}
+        if cmd == "HGETALL":
+            fields = self.store.get(key, {})
+            return {"result": [item for pair in fields.items() for item in pair]}
+        raise NotImplementedError(cmd)
+
+    def request(self, url: str, data: Optional[str] = None, json: Any = None) -> Any:
+        path = "/" + url.split("/", 3)[3]
+        self.requests.append((path, json or data))
+        if path == "/pipeline":
+            # commands can fail one by one, the request itself still succeeds
+            return FakeUpstashResponse(200, [self.run(*cmd) for cmd in json])
+        args = path.split("/")[1:] + ([data] if data is not None else [])
+        body = self.run(*args)
+        return FakeUpstashResponse(400 if "error" in body else 200, body)
+
+    def get(self, url: str, **_: Any) -> FakeUpstashResponse:
+        return self.request(url)
+
+    def post(
+        self, url: str, data: Optional[str] = None, json: Any = None, **_: Any
+    ) -> Any:
+        return self.request(url, data, json)
+
+
+@pytest.fixture(name="upstash")
+def fake_upstash(monkeypatch: pytest.MonkeyPatch) -> FakeUpstash:
+    """Makes pdictng's Upstash client talk to a FakeUpstash"""
+    upstash = FakeUpstash()
+
+    async def get_session() -> FakeUpstash:
+        return upstash
+
+    monkeypatch.setattr(pdictng, "_get_session", get_session)
+    return upstash
+
+
+@pytest.mark.asyncio
+async def test_upstash_fields(upstash: FakeUpstash) -> None:
+    """Tests how fields are sent to and read back from Upstash"""
+    client = pdictng.fasterpKVStoreClient()
+    key = pdictng._salted(f"{client.namespace}_wire_fields")
+    await client.post_fields("wire", {"a": "1", "b": None})
+    assert len(upstash.requests) == 1
+    path, (hset, hdel) = upstash.requests[0]
+    assert path == "/pipeline"
+    # the marker field, then salted field names with the encrypted name and value
+    assert hset[:5] == ["HSET", key, "_", "1", pdictng._salted("a")]
+    assert pdictng._loads(get_cleartext_value(hset[5])) == ["a", "1"]
+    assert hdel == ["HDEL", key, pdictng._salted("b")]
+    assert await client.get_fields("wire") == {"a": "1"}
+    await client.post_field("wire", "b", "2")
+    assert await client.get_fields("wire") == {"a": "1", "b": "2"}
+    await client.post_fields("wire", {"a": None, "b": None})
+    # the marker tells a hash with no fields left from one that was never written
+    assert await client.get_fields("wire") == {}
+    assert await client.get_fields("never") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("upstash")
+async def test_upstash_migration() -> None:
+    """Tests that a whole-dict value written by older versions is moved to fields"""
+    client = pdictng.fasterpKVStoreClient()
+    key = f"Persist_migrate_{pdictng.NAMESPACE}"
+    await client.post(key, pdictng._dumps({"a": 1, "b": [2]}))
+    pdict: pdictng.aPersistDict = pdictng.aPersistDict("migrate")
+    await pdict.init_task
+    assert await pdict.get("b") == [2]
+    assert await client.get_fields(key) == {"a": "1", "b": "[2]"}
+    # older versions can still read the old value
+    assert pdictng._loads(await client.get(key)) == {"a": 1, "b": [2]}
+    await pdict.set("a", None)
+    reloaded: pdictng.aPersistDict = pdictng.aPersistDict("migrate")
+    assert await reloaded.keys() == ["b"]
+    # a new dict has neither, and isn't migrated
+    new: pdictng.aPersistDict = pdictng.aPersistDict("new")
+    await new.init_task
+    assert await client.get_fields(new.client_key) is None
+
+
+@pytest.mark.asyncio
+async def test_upstash_errors(upstash: FakeUpstash) -> None:
+    """Tests that Upstash errors are raised, and a failed migration doesn't lose data"""
+    client = pdictng.fasterpKVStoreClient()
+    upstash.failing = {"SET", "HSET", "HGETALL"}
+    with pytest.raises(ValueError):
+        await client.post("errors", "1")
+    with pytest.raises(ValueError):
+        await client.post_fields("errors", {"a": "1"})
+    with pytest.raises(ValueError):
+        await client.get_fields("errors")
+    upstash.failing = set()
+    key = f"Persist_errors_{pdictng.NAMESPACE}"
+    await client.post(key, pdictng._dumps({"a": 1}))
+    upstash.failing = {"HSET"}
+    pdict: pdictng.aPersistDict = pdictng.aPersistDict("errors")
+    with pytest.raises(ValueError):
+        await pdict.init_task
+    assert await client.get_fields(key) is None
+    assert pdictng._loads(await client.get(key)) == {"a": 1}
+    # so the next start tries again
+    upstash.failing = set()
+    retried: pdictng.aPersistDict = pdictng.aPersistDict("errors")
+    assert await retried.get("a") == 1
+    assert await client.get_fields(key) == {"a": "1"}